@@ -5,6 +5,8 @@ class Settings(BaseSettings):
     ESTAT_API_KEY: str
     ESTAT_API_VERSION: str = "3.0"
     ESTAT_BASE_URL: str = "https://api.e-stat.go.jp/rest/3.0/app/json"
+    # メタ情報(CLASS_INF)キャッシュの有効期間(秒)
+    ESTAT_META_CACHE_TTL: int = 86400
 
     model_config = SettingsConfigDict(
         env_file="/workspace/.env",
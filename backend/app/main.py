@@ -1,13 +1,35 @@
 import asyncio
+import hashlib
+import os
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 import uvicorn
+import orjson
 from fastapi import FastAPI, HTTPException, Query
+from fastapi.responses import JSONResponse
+import numpy as np
 import pandas as pd
 from typing import Optional
 from app.services.estat_services import estat_services
 from app.services.viz_services import viz_service
 from app.services.analysis_services import EconometricEngine
 
-app = FastAPI(title="Macro-Micro Linkage API")
+class NumpyORJSONResponse(JSONResponse):
+    """orjson でシリアライズするレスポンス。NumPy配列は Python の float に変換せずそのまま出力する。"""
+
+    def render(self, content) -> bytes:
+        return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY)
+
+app = FastAPI(title="Macro-Micro Linkage API", default_response_class=NumpyORJSONResponse)
+
+# SARIMA推定はCPUバウンドなので、GILを避けてプロセスプールで並列実行する
+_PREDICT_POOL = ProcessPoolExecutor(max_workers=os.cpu_count())
+
+@app.on_event("shutdown")
+async def shutdown_resources():
+    _PREDICT_POOL.shutdown(wait=False, cancel_futures=True)
+    await estat_services.aclose()
 
 @app.get("/")
 def read_root():
@@ -67,7 +89,14 @@ async def get_analysis_data(
 
         target_col = cat_cols[0]
         wide_df = estat_services.to_wide_format(df, columns_col=target_col)
-        data_dict = wide_df.reset_index().replace({pd.NaT: None}).to_dict(orient="records")
+        # 行ごとのdict(records)ではなく列名+2次元リストの split 形式で返す
+        wide_reset = wide_df.reset_index().astype(object)
+        wide_reset = wide_reset.where(wide_reset.notna(), None)
+        data_dict = {
+            "columns": wide_reset.columns.tolist(),
+            "index": wide_reset.index.tolist(),
+            "data": wide_reset.values.tolist()
+        }
 
         return {
             "status": "success",
@@ -78,14 +107,129 @@ async def get_analysis_data(
         raise HTTPException(status_code=500, detail=str(e))
 
 
-def run_analysis_task(target_series: pd.Series, n_periods: int):
-    """Offloads the heavy fit/predict logic to a separate thread."""
-    engine = EconometricEngine(target_series=target_series)
-    fit_result = engine.fit(seasonal=True, m=12)
+def run_analysis_task(target_series: pd.Series, n_periods: int, d: Optional[int] = None):
+    """Offloads the heavy fit/predict logic to a worker process (must stay top-level to be picklable)."""
+    # target_series は to_wide_format の出力 (DatetimeIndex・昇順ソート済み) なので検証を省略する
+    engine = EconometricEngine(target_series=target_series, fast=True)
+    fit_result = engine.fit(seasonal=True, m=12, d=d)
     diagnosis = engine.diagnose()
     forecast = engine.predict(n_periods=n_periods)
     return fit_result, diagnosis, forecast
 
+
+async def run_analysis_in_pool(target_series: pd.Series, n_periods: int, d: Optional[int] = None):
+    """
+    run_analysis_task をプロセスプールで実行する。
+    ワーカーが異常終了してプールが壊れた場合は、作り直して1回だけ再試行する。
+    """
+    global _PREDICT_POOL
+    loop = asyncio.get_running_loop()
+    pool = _PREDICT_POOL
+    try:
+        return await loop.run_in_executor(pool, run_analysis_task, target_series, n_periods, d)
+    except BrokenProcessPool:
+        # 同じクラッシュで失敗した他のリクエストが既に作り直していれば、そのプールを使う
+        if _PREDICT_POOL is pool:
+            pool.shutdown(wait=False, cancel_futures=True)
+            _PREDICT_POOL = ProcessPoolExecutor(max_workers=os.cpu_count())
+        return await loop.run_in_executor(_PREDICT_POOL, run_analysis_task, target_series, n_periods, d)
+
+
+# SARIMAの推定結果キャッシュ (月次データは月1回しか更新されないため、同一系列の再推定を省く)
+_ANALYSIS_CACHE_MAXSIZE = 128
+_analysis_cache: "OrderedDict[tuple, tuple]" = OrderedDict()
+# 系列ごとの階差次数 d のキャッシュ (予測期間だけ変えた再リクエストで単位根検定を省く)
+_diff_order_cache: "OrderedDict[str, int]" = OrderedDict()
+
+
+def _series_digest(target_series: pd.Series) -> str:
+    """系列の中身(値+日付)のハッシュを返す。"""
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(target_series.values.tobytes())
+    digest.update(target_series.index.asi8.tobytes())
+    return digest.hexdigest()
+
+
+def _analysis_cache_key(stats_data_id: str, cat: str, area: str, target_series: pd.Series, digest: str, n_periods: int) -> tuple:
+    """系列の中身のハッシュを含めたキャッシュキーを生成する。"""
+    return (stats_data_id, cat, area, len(target_series), digest, n_periods)
+
+
+def _cache_get(cache: OrderedDict, key):
+    result = cache.get(key)
+    if result is not None:
+        cache.move_to_end(key)
+    return result
+
+
+def _cache_set(cache: OrderedDict, key, result) -> None:
+    cache[key] = result
+    cache.move_to_end(key)
+    while len(cache) > _ANALYSIS_CACHE_MAXSIZE:
+        cache.popitem(last=False)
+
+async def _predict_one(stats_data_id: str, cat: str, area: str, n_periods: int) -> dict:
+    """
+    1系列分の「取得 -> 整形 -> 推定 -> 予測」を実行し、レスポンス用のdictを返す。
+    入力起因のエラーは HTTPException として送出する。
+    """
+    # 1. データの非同期取得
+    params = {"cdCat01": cat, "cdArea": area}
+    df = await estat_services.fetch_stats_data(stats_data_id, params=params)
+
+    if df.empty:
+        raise HTTPException(status_code=404, detail="データが見つかりませんでした。")
+
+    # 2. データの整形
+    cat_cols = [c for c in df.columns if "品目" in c]
+    if not cat_cols:
+         raise HTTPException(status_code=500, detail="品目カラムの特定に失敗しました。")
+    target_col_name = cat_cols[0]
+
+    wide_df = estat_services.to_wide_format(df, columns_col=target_col_name)
+    if wide_df.empty:
+         raise HTTPException(status_code=404, detail="Wide Format変換に失敗しました。")
+
+    target_series = wide_df.iloc[:, 0]
+    if len(target_series) < 24:
+         raise HTTPException(status_code=400, detail=f"データ点数不足({len(target_series)}件)。最低24件必要です。")
+
+    # 3. 重い計算を別プロセスへ委譲（ここでサーバー停止を防ぐ）
+    #    同一系列・同一予測期間ならキャッシュ済みの結果を返す
+    digest = _series_digest(target_series)
+    cache_key = _analysis_cache_key(stats_data_id, cat, area, target_series, digest, n_periods)
+    cached = _cache_get(_analysis_cache, cache_key)
+    if cached is not None:
+        fit_result, diagnosis, forecast = cached
+    else:
+        d = _cache_get(_diff_order_cache, digest)
+        fit_result, diagnosis, forecast = await run_analysis_in_pool(target_series, n_periods, d)
+        _cache_set(_analysis_cache, cache_key, (fit_result, diagnosis, forecast))
+        _cache_set(_diff_order_cache, digest, fit_result["d"])
+
+    # 4. 結果の返却
+    history_dates = target_series.index.strftime('%Y-%m-%d').tolist()
+    history_values = np.ascontiguousarray(target_series.to_numpy(dtype=np.float64))
+
+    return {
+        "status": "success",
+        "metadata": {
+            "stats_id": stats_data_id,
+            "cat": cat,
+            "area": area,
+            "model_order": str(fit_result["order"]),
+            "seasonal_order": str(fit_result["seasonal_order"]),
+            "aic": fit_result["aic"],
+            "is_white_noise": diagnosis["is_white_noise"],
+            "lb_pvalue": diagnosis["lb_pvalue"]
+        },
+        "history": {
+            "index": history_dates,
+            "values": history_values
+        },
+        "forecast": forecast
+    }
+
 @app.get("/analysis/predict/{stats_data_id}")
 async def predict_time_series(
     stats_data_id: str,
@@ -95,61 +239,49 @@ async def predict_time_series(
     ):
     """
     時系列予測(SARIMA)を実行するエンドポイント。
-    asyncio.to_thread を使用してブロッキングを回避。
+    ProcessPoolExecutor を使用してブロッキングを回避し、複数リクエストをCPUコア間で並列処理する。
     """
     try:
-        # 1. データの非同期取得
-        params = {"cdCat01": cat, "cdArea": area}
-        df = await estat_services.fetch_stats_data(stats_data_id, params=params)
+        # NumPy配列を含むため jsonable_encoder を通さずに直接レスポンスを返す
+        return NumpyORJSONResponse(await _predict_one(stats_data_id, cat, area, n_periods))
 
-        if df.empty:
-            raise HTTPException(status_code=404, detail="データが見つかりませんでした。")
-
-        # 2. データの整形
-        cat_cols = [c for c in df.columns if "品目" in c]
-        if not cat_cols:
-             raise HTTPException(status_code=500, detail="品目カラムの特定に失敗しました。")
-        target_col_name = cat_cols[0]
+    except HTTPException as he:
+        raise he
+    except Exception as e:
+        import traceback
+        traceback.print_exc()
+        raise HTTPException(status_code=500, detail=f"Internal Analysis Error: {str(e)}")
 
-        wide_df = estat_services.to_wide_format(df, columns_col=target_col_name)
-        if wide_df.empty:
-             raise HTTPException(status_code=404, detail="Wide Format変換に失敗しました。")
+# 一括予測時の同時実行数 (e-Stat への同時リクエスト数の上限)
+BATCH_CONCURRENCY = 8
 
-        target_series = wide_df.iloc[:, 0]
-        if len(target_series) < 24:
-             raise HTTPException(status_code=400, detail=f"データ点数不足({len(target_series)}件)。最低24件必要です。")
+@app.get("/analysis/batch/predict")
+async def predict_time_series_batch(
+    ids: list[str] = Query(..., description="統計表IDのリスト (?ids=A&ids=B)"),
+    cat: str = "0001",
+    area: str = "00000",
+    n_periods: int = 12
+    ):
+    """
+    複数の統計表IDについて時系列予測を並行実行するエンドポイント。
+    取得・推定は asyncio.gather で同時に走らせ、Semaphore で同時実行数を制限する。
+    1件の失敗が他のIDの結果に影響しないよう、IDごとにエラーを返す。
+    """
+    sem = asyncio.Semaphore(BATCH_CONCURRENCY)
 
-        # 3. 重い計算を別スレッドへ委譲（ここでサーバー停止を防ぐ）
-        fit_result, diagnosis, forecast = await asyncio.to_thread(
-        run_analysis_task, target_series, n_periods
-        )
+    async def run_one(stats_data_id: str) -> dict:
+        async with sem:
+            return await _predict_one(stats_data_id, cat, area, n_periods)
 
-        # 4. 結果の返却
-        history_dates = target_series.index.strftime('%Y-%m-%d').tolist()
-        history_values = target_series.values.tolist()
+    results = await asyncio.gather(*(run_one(i) for i in ids), return_exceptions=True)
 
-        return {
-            "status": "success",
-            "metadata": {
-                "stats_id": stats_data_id,
-                "cat": cat,
-                "area": area,
-                "model_order": str(fit_result["order"]),
-                "seasonal_order": str(fit_result["seasonal_order"]),
-                "aic": fit_result["aic"],
-                "is_white_noise": diagnosis["is_white_noise"],
-                "lb_pvalue": diagnosis["lb_pvalue"]
-            },
-            "history": {
-                "index": history_dates,
-                "values": history_values
-            },
-            "forecast": forecast
-        }
+    payload = {}
+    for stats_data_id, result in zip(ids, results):
+        if isinstance(result, HTTPException):
+            payload[stats_data_id] = {"status": "error", "status_code": result.status_code, "detail": result.detail}
+        elif isinstance(result, Exception):
+            payload[stats_data_id] = {"status": "error", "status_code": 500, "detail": f"Internal Analysis Error: {str(result)}"}
+        else:
+            payload[stats_data_id] = result
 
-    except HTTPException as he:
-        raise he
-    except Exception as e:
-        import traceback
-        traceback.print_exc()
-        raise HTTPException(status_code=500, detail=f"Internal Analysis Error: {str(e)}")
\ No newline at end of file
+    return NumpyORJSONResponse({"status": "success", "results": payload})
\ No newline at end of file
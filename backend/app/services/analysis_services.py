@@ -1,45 +1,66 @@
 import pandas as pd
 import numpy as np
-import pmdarima as pm
-from statsmodels.stats.diagnostic import acorr_ljungbox
+from statsforecast.models import AutoARIMA
+from statsforecast.arima import ndiffs, diff
+from scipy.stats import chi2
 from typing import Dict, Any, Optional, List
 import logging
 
-# --- DEBUG設定: ログを強制的に標準出力に出す ---
-logging.basicConfig(level=logging.INFO)
+# ログレベルの設定はアプリ側(uvicorn等)に任せる。DEBUG出力は isEnabledFor で囲み、無効時のコストを避ける
 logger = logging.getLogger(__name__)
 
+def _ljung_box_pvalue(residuals: np.ndarray, lag: int) -> float:
+    """
+    Ljung-Box 検定の p 値を NumPy で直接計算する。
+    Q = n(n+2) * Σ_{k=1..h} r_k^2 / (n-k)  (r_k: ラグ k の標本自己相関)
+    statsmodels の acorr_ljungbox と同じ値になるが、DataFrame を作らない。
+    """
+    x = residuals - residuals.mean()
+    n = x.shape[0]
+    denom = np.dot(x, x)
+    q = 0.0
+    for k in range(1, lag + 1):
+        r_k = np.dot(x[:-k], x[k:]) / denom
+        q += r_k * r_k / (n - k)
+    q *= n * (n + 2)
+    return float(chi2.sf(q, lag))
+
 class EconometricEngine:
     """
     Econometric Analysis Engine for Macro-Micro Linkage.
     """
 
-    def __init__(self, target_series: pd.Series, exog_series: Optional[pd.DataFrame] = None):
-        logger.info("=== [Init] EconometricEngine Initialized ===")
+    def __init__(self, target_series: pd.Series, exog_series: Optional[pd.DataFrame] = None, fast: bool = False):
+        """
+        `fast=True` は、入力が既に「DatetimeIndex かつ昇順ソート済み」であることを呼び出し側が保証する場合に使う。
+        (EStatService.to_wide_format の出力はこの条件を満たす)
+        """
+        logger.debug("=== [Init] EconometricEngine Initialized ===")
         # 初期化時にバリデーションとソートを実行
-        self.y = self._validate_and_set_freq(target_series, name="Target(y)")
-        self.exog = self._validate_and_set_freq(exog_series, name="Exog(X)") if exog_series is not None else None
+        self.y = self._validate_and_set_freq(target_series, name="Target(y)", fast=fast)
+        self.exog = self._validate_and_set_freq(exog_series, name="Exog(X)", fast=fast) if exog_series is not None else None
         self.model = None
 
-    def _validate_and_set_freq(self, data: pd.Series | pd.DataFrame, name: str) -> pd.Series | pd.DataFrame:
+    def _validate_and_set_freq(self, data: pd.Series | pd.DataFrame, name: str, fast: bool = False) -> pd.Series | pd.DataFrame:
         if data is None: return None
-        data = data.copy()
+        # 入力は書き換えず、各ステップで新しいオブジェクトを返す (先頭での丸ごとコピーは不要)
         
         # --- DEBUG 1: 入力直後の状態を確認 ---
-        logger.info(f"--- DEBUG [{name}]: Raw Input ---")
-        logger.info(f"Index Type: {type(data.index)}")
-        # スライスエラー回避のためチェック
-        if len(data) >= 3:
-            logger.info(f"Top 3 Index: {data.index[:3].tolist()}")
-            logger.info(f"Tail 3 Index: {data.index[-3:].tolist()}")
-        else:
-            logger.info(f"All Index: {data.index.tolist()}")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"--- DEBUG [{name}]: Raw Input ---")
+            logger.debug(f"Index Type: {type(data.index)}")
+            # スライスエラー回避のためチェック
+            if len(data) >= 3:
+                logger.debug(f"Top 3 Index: {data.index[:3].tolist()}")
+                logger.debug(f"Tail 3 Index: {data.index[-3:].tolist()}")
+            else:
+                logger.debug(f"All Index: {data.index.tolist()}")
         
-        # 1. IndexをDatetime型に変換
-        if not isinstance(data.index, pd.DatetimeIndex):
+        # 1. IndexをDatetime型に変換 (fast の場合は DatetimeIndex であることが保証済み)
+        if not fast and not isinstance(data.index, pd.DatetimeIndex):
             try:
-                data.index = pd.to_datetime(data.index)
-                logger.info(f"[{name}] Converted index to DatetimeIndex.")
+                data = data.set_axis(pd.to_datetime(data.index))
+                logger.debug(f"[{name}] Converted index to DatetimeIndex.")
             except Exception as e:
                 logger.error(f"[{name}] Index conversion failed: {e}")
                 raise ValueError(f"Index conversion failed: {e}")
@@ -48,20 +69,24 @@ class EconometricEngine:
         if data.empty:
             raise ValueError(f"Dataset {name} is empty.")
 
-        # 3. 強制ソート (ここが効いているか確認する)
-        data.sort_index(ascending=True, inplace=True)
+        # 3. 強制ソート (fast の場合は昇順ソート済みであることが保証済み)
+        if not fast:
+            data = data.sort_index(ascending=True)
 
         # 4. 頻度設定 & 欠損処理
-        data = data.resample('MS').mean()
-        data = data.interpolate(method='linear')
-        data = data.astype(float)
+        data = data.resample('MS').mean().interpolate(method='linear')
+        # 既に float64 なら型変換によるコピーを省く
+        is_float64 = (data.dtypes == np.float64).all() if isinstance(data, pd.DataFrame) else data.dtype == np.float64
+        if not is_float64:
+            data = data.astype(np.float64)
 
         # --- DEBUG 2: 処理完了後の状態を確認 ---
-        logger.info(f"--- DEBUG [{name}]: After Processing ---")
         if not data.empty:
-            logger.info(f"Start Date (Should be Oldest): {data.index[0]}")
-            logger.info(f"End Date (Should be Newest):   {data.index[-1]}")
-            logger.info(f"Total Rows: {len(data)}")
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"--- DEBUG [{name}]: After Processing ---")
+                logger.debug(f"Start Date (Should be Oldest): {data.index[0]}")
+                logger.debug(f"End Date (Should be Newest):   {data.index[-1]}")
+                logger.debug(f"Total Rows: {len(data)}")
             
             # もしEnd Dateが1970年代なら、ここで警告を出す
             if data.index[-1].year < 2000:
@@ -69,46 +94,58 @@ class EconometricEngine:
 
         return data
 
-    def fit(self, seasonal: bool = True, m: int = 12) -> Dict[str, Any]:
+    def fit(self, seasonal: bool = True, m: int = 12, d: Optional[int] = None) -> Dict[str, Any]:
         """
         Builds the optimal SARIMA/SARIMAX model.
+        `d` (非季節階差の次数) が既知なら渡すことで、KPSS検定を省略できる。
         """
         y_train = self.y
         exog_train = self.exog
         
-        if y_train is not None and not y_train.empty:
-            logger.info(f"Fitting model with {len(y_train)} records. Range: {y_train.index[0].date()} -> {y_train.index[-1].date()}")
+        if y_train is not None and not y_train.empty and logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"Fitting model with {len(y_train)} records. Range: {y_train.index[0].date()} -> {y_train.index[-1].date()}")
+
+        # 階差次数は探索前に1回だけ決める (結果は呼び出し側でキャッシュして再利用できる)
+        # AutoARIMA と同様、季節階差(D=1)を取った系列に対して KPSS 検定を行う
+        y_values = y_train.to_numpy(dtype=np.float64)
+        if d is None:
+            dx = diff(y_values, lag=m, differences=1) if seasonal else y_values
+            d = ndiffs(dx, test='kpss', max_d=2)
 
-        self.model = pm.auto_arima(
-            y=y_train,
-            X=exog_train,
+        # statsforecast の AutoARIMA (numba 実装) で次数を探索する
+        self.model = AutoARIMA(
             seasonal=seasonal,
-            m=m,
+            season_length=m if seasonal else 1,
             start_p=0, max_p=2,
             start_q=0, max_q=2,
             start_P=0, max_P=1,
             start_Q=0, max_Q=1,
-            d=None, D=1,
+            d=d, D=1 if seasonal else 0,
+            ic='aic',
             stepwise=True,
-            suppress_warnings=True,
-            error_action='ignore'
+        )
+        self.model.fit(
+            y=y_values,
+            X=exog_train.to_numpy(dtype=np.float64) if exog_train is not None else None,
         )
 
+        # arma = (p, q, P, Q, m, d, D)
+        p, q, P, Q, period, d_fit, D_fit = (int(v) for v in self.model.model_['arma'])
         return {
-            "order": self.model.order,
-            "seasonal_order": self.model.seasonal_order,
-            "aic": self.model.aic(),
-            "bic": self.model.bic()
+            "order": (p, d_fit, q),
+            "d": int(d),
+            "seasonal_order": (P, D_fit, Q, period),
+            "aic": float(self.model.model_['aic']),
+            "bic": float(self.model.model_['bic'])
         }
 
     # ▼▼▼ 復活させたメソッド ▼▼▼
     def diagnose(self) -> Dict[str, Any]:
         if self.model is None: raise RuntimeError("Model not fitted.")
-        residuals = self.model.resid()
+        residuals = np.asarray(self.model.model_['residuals'], dtype=np.float64)
         # Ensure enough data points for Ljung-Box
-        lags = [12] if len(residuals) > 12 else [1]
-        lb_df = acorr_ljungbox(residuals, lags=lags, return_df=True)
-        lb_pvalue = float(lb_df['lb_pvalue'].iloc[0])
+        lag = 12 if len(residuals) > 12 else 1
+        lb_pvalue = _ljung_box_pvalue(residuals, lag)
         return {
             "lb_pvalue": lb_pvalue,
             "is_white_noise": lb_pvalue > 0.05,
@@ -119,21 +156,26 @@ class EconometricEngine:
     def predict(self, n_periods: int = 12, future_exog: Optional[pd.DataFrame] = None) -> Dict[str, Any]:
         if self.model is None: raise RuntimeError("Model not fitted.")
         
-        preds, conf_int = self.model.predict(n_periods=n_periods, X=future_exog, return_conf_int=True, alpha=0.05)
+        # 平均と95%予測区間を1回の呼び出しで取得する
+        fcst = self.model.predict(
+            h=n_periods,
+            X=future_exog.to_numpy(dtype=np.float64) if future_exog is not None else None,
+            level=[95],
+        )
         
         # 予測の起点をログ出力
         last_date = self.y.index[-1]
-        logger.info(f"--- DEBUG [Predict] ---")
-        logger.info(f"Base Date (End of History): {last_date}")
-        
         future_dates = pd.date_range(start=last_date, periods=n_periods + 1, freq='MS')[1:]
-        
-        logger.info(f"Forecast Start: {future_dates[0]}")
-        logger.info(f"Forecast End:   {future_dates[-1]}")
+
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("--- DEBUG [Predict] ---")
+            logger.debug(f"Base Date (End of History): {last_date}")
+            logger.debug(f"Forecast Start: {future_dates[0]}")
+            logger.debug(f"Forecast End:   {future_dates[-1]}")
 
         return {
             "index": future_dates.strftime('%Y-%m-%d').tolist(),
-            "mean": preds.tolist(),
-            "lower": conf_int[:, 0].tolist(),
-            "upper": conf_int[:, 1].tolist()
+            "mean": fcst["mean"].tolist(),
+            "lower": fcst["lo-95"].tolist(),
+            "upper": fcst["hi-95"].tolist()
         }
\ No newline at end of file
@@ -1,42 +1,98 @@
+import time
 import httpx
+import orjson
 import pandas as pd
 import numpy as np
 from typing import Dict, Any, Optional, List
 from app.core.config import settings
 import logging
 
-# ログ設定: Dockerのログで「どんな日付文字列が来ているか」を見えるようにする
-logging.basicConfig(level=logging.INFO)
+# 「どんな日付文字列が来ているか」は DEBUG レベルで確認する (ログレベルの設定はアプリ側に任せる)
 logger = logging.getLogger(__name__)
 
 class EStatService:
     def __init__(self):
         self.base_url = settings.ESTAT_BASE_URL
         self.api_key = settings.ESTAT_API_KEY
+        # リクエストごとにTCP/TLS接続を張り直さないよう、クライアントを使い回す
+        self._client = httpx.AsyncClient(
+            base_url=self.base_url,
+            timeout=30.0,
+            limits=httpx.Limits(max_keepalive_connections=20, max_connections=100),
+            http2=True,
+        )
+        # メタ情報(CLASS_INF)はほぼ静的なので、(統計表ID, 絞り込み条件)ごとにプロセス内で保持する
+        # 値は (取得時刻, class_info, 分類ごとの既知コード集合)
+        self._meta_cache: Dict[tuple, tuple] = {}
+        self.meta_cache_ttl = settings.ESTAT_META_CACHE_TTL
+
+    async def aclose(self) -> None:
+        """共有しているHTTPクライアントの接続プールを閉じる。"""
+        await self._client.aclose()
+
+    def _get_cached_meta(self, key: tuple) -> Optional[tuple]:
+        """(class_info, 既知コード集合) を返す。未登録または期限切れなら None。"""
+        entry = self._meta_cache.get(key)
+        if entry is None:
+            return None
+        fetched_at, class_info, known_codes = entry
+        if time.monotonic() - fetched_at > self.meta_cache_ttl:
+            self._meta_cache.pop(key, None)
+            return None
+        return class_info, known_codes
+
+    def _collect_codes(self, json_data: Dict[str, Any], class_info: List[Dict[str, Any]]) -> Dict[str, set]:
+        """レスポンスの VALUE に現れるコードを分類(@id)ごとに集める。"""
+        values = json_data.get("GET_STATS_DATA", {}).get("STATISTICAL_DATA", {}).get("DATA_INF", {}).get("VALUE", [])
+        if isinstance(values, dict):
+            values = [values]
+        col_ids = [f"@{obj['@id']}" for obj in class_info]
+        return {col_id: {v.get(col_id) for v in values} - {None} for col_id in col_ids}
+
+    def _known_codes(self, json_data: Dict[str, Any], class_info: List[Dict[str, Any]]) -> Dict[str, frozenset]:
+        """
+        キャッシュ時点で「既知」とみなすコード集合。
+        CLASS_INF のコードに加え、そのレスポンスに現れたコード(ラベル未定義のものも含む)を登録しておき、
+        以後の metaGetFlg=N のレスポンスで未知のコード(例: 新しく公表された月)が出たらキャッシュを捨てる。
+        """
+        seen = self._collect_codes(json_data, class_info)
+        known = {}
+        for obj in class_info:
+            col_id = f"@{obj['@id']}"
+            class_list = obj.get("CLASS", [])
+            if isinstance(class_list, dict):
+                class_list = [class_list]
+            known[col_id] = frozenset(item["@code"] for item in class_list if "@code" in item) | seen[col_id]
+        return known
 
     async def fetch_stats_data(self, stats_data_id: str, params: Optional[Dict[str, Any]] = None) -> pd.DataFrame:
         """
         e-Stat APIからデータを取得し、API側のエラーを明示的に検知して例外を投げる。
+        メタ情報がキャッシュ済みなら metaGetFlg=N で数値データのみを取得する。
         """
+        meta_key = (stats_data_id, tuple(sorted((params or {}).items())))
+        cached_meta = self._get_cached_meta(meta_key)
+        # cached_meta がある場合は (class_info, 既知コード集合)
+
         query_params = {
             "appId": self.api_key,
             "statsDataId": stats_data_id,
-            "metaGetFlg": "Y",
+            "metaGetFlg": "N" if cached_meta is not None else "Y",
             "cntGetFlg": "N",
         }
         if params:
             query_params.update(params)
 
-        logger.info(f"Requesting e-Stat API: {self.base_url}/getStatsData with params {query_params}")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"Requesting e-Stat API: {self.base_url}/getStatsData with params {query_params}")
 
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            try:
-                response = await client.get(f"{self.base_url}/getStatsData", params=query_params)
-                response.raise_for_status()
-                data = response.json()
-            except Exception as e:
-                logger.error(f"e-Stat API Connection Error: {e}")
-                raise ValueError(f"通信エラーが発生しました: {e}")
+        try:
+            response = await self._client.get("/getStatsData", params=query_params)
+            response.raise_for_status()
+            data = orjson.loads(response.content)
+        except Exception as e:
+            logger.error(f"e-Stat API Connection Error: {e}")
+            raise ValueError(f"通信エラーが発生しました: {e}")
 
         # APIレスポンス内のステータスチェック
         root = data.get("GET_STATS_DATA", {})
@@ -44,13 +100,39 @@ class EStatService:
         status = str(result.get("STATUS", "999"))
         
         if status != "0":
+            self._meta_cache.pop(meta_key, None)
             error_msg = result.get("ERROR_MSG", "Unknown Error")
             logger.error(f"e-Stat API Error: {status} - {error_msg}")
             raise ValueError(f"e-Stat APIエラー [Code {status}]: {error_msg}")
 
-        return self._transform_to_tidy_data(data)
+        if cached_meta is None:
+            class_info = self._extract_class_info(data)
+            if class_info:
+                self._meta_cache[meta_key] = (time.monotonic(), class_info, self._known_codes(data, class_info))
+            return self._transform_to_tidy_data(data, class_info)
 
-    def _transform_to_tidy_data(self, json_data: Dict[str, Any]) -> pd.DataFrame:
+        # キャッシュにないコードが含まれていればメタ情報が古い -> 捨てて metaGetFlg=Y で取り直す
+        class_info, known_codes = cached_meta
+        seen = self._collect_codes(data, class_info)
+        if any(codes - known_codes[col_id] for col_id, codes in seen.items()):
+            logger.info(f"e-Stat metadata cache is stale for {stats_data_id}; refetching with metaGetFlg=Y")
+            self._meta_cache.pop(meta_key, None)
+            return await self.fetch_stats_data(stats_data_id, params)
+
+        return self._transform_to_tidy_data(data, class_info)
+
+    def _extract_class_info(self, json_data: Dict[str, Any]) -> List[Dict[str, Any]]:
+        stat_data = json_data.get("GET_STATS_DATA", {}).get("STATISTICAL_DATA", {})
+        class_info = stat_data.get("CLASS_INF", {}).get("CLASS_OBJ", [])
+        if isinstance(class_info, dict):
+            class_info = [class_info]
+        return class_info
+
+    def _transform_to_tidy_data(self, json_data: Dict[str, Any], class_info: Optional[List[Dict[str, Any]]] = None) -> pd.DataFrame:
+        """
+        e-Stat のレスポンスを Tidy Data に変換する。
+        class_info を省略した場合はレスポンス内の CLASS_INF を使う。
+        """
         stat_data = json_data.get("GET_STATS_DATA", {}).get("STATISTICAL_DATA", {})
         if not stat_data:
             raise ValueError("統計データ(STATISTICAL_DATA)が空です。")
@@ -58,14 +140,15 @@ class EStatService:
         values = stat_data.get("DATA_INF", {}).get("VALUE", [])
         if isinstance(values, dict):
             values = [values]
-            
-        df = pd.DataFrame(values)
+
+        # 行dictのリストではなく列ごとのリストから組み立てる (注記列など一部の行にしかないキーも拾う)
+        keys = dict.fromkeys(k for v in values for k in v)
+        df = pd.DataFrame({k: [v.get(k) for v in values] for k in keys}, copy=False)
         if df.empty:
             raise ValueError("取得されたデータが0件です。パラメータ(cat/area)が間違っている可能性があります。")
 
-        class_info = stat_data.get("CLASS_INF", {}).get("CLASS_OBJ", [])
-        if isinstance(class_info, dict):
-            class_info = [class_info]
+        if class_info is None:
+            class_info = self._extract_class_info(json_data)
             
         df = self._apply_metadata(df, class_info)
 
@@ -79,35 +162,15 @@ class EStatService:
             time_col = time_cols[0]
             df = df.rename(columns={time_col: "date"})
             
-            # --- 修正: 強固な日付パースロジック ---
-            def parse_date_robust(x):
-                s = str(x).strip()
-                try:
-                    if "月" in s: return pd.to_datetime(s.replace("年", "-").replace("月", "-01"))
-                    if "年度" in s: return pd.to_datetime(s.replace("年度", "-04-01"))
-                    if "年" in s: return pd.to_datetime(s.replace("年", "-01-01"))
-                    
-                    # YYYYMM (6桁) -> 202301 -> 2023-01-01
-                    if s.isdigit() and len(s) == 6:
-                        return pd.to_datetime(s, format="%Y%m")
-                    # YYYYMMDD (8桁)
-                    if s.isdigit() and len(s) == 8:
-                        return pd.to_datetime(s, format="%Y%m%d")
-                    # YYYY (4桁)
-                    if s.isdigit() and len(s) == 4:
-                        return pd.to_datetime(s, format="%Y")
-                    
-                    return pd.to_datetime(s, errors='coerce')
-                except:
-                    return pd.NaT
-            
             # 生データのサンプルをログに出す（デバッグ用）
-            logger.info(f"Raw Date Samples (Before Parse): {df['date'].head().tolist()}")
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"Raw Date Samples (Before Parse): {df['date'].head().tolist()}")
             
-            df["date"] = df["date"].apply(parse_date_robust)
+            df["date"] = self._parse_dates(df["date"])
             
             # パース後のチェック
-            logger.info(f"Parsed Date Samples: {df['date'].head().tolist()}")
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"Parsed Date Samples: {df['date'].head().tolist()}")
             
             # NaTを除去し、日付で昇順ソート (1970...2024の順に並べる)
             df = df.dropna(subset=["date"]).sort_values("date", ascending=True).reset_index(drop=True)
@@ -117,17 +180,76 @@ class EStatService:
 
         return df
 
+    def _parse_dates(self, dates: pd.Series) -> pd.Series:
+        """
+        e-Stat の不統一な時間軸表記をフォーマットごとにまとめて一括パースする。
+        (行ごとの apply ではなく、パターン別のマスク + format 指定の to_datetime)
+        """
+        s = dates.astype(str).str.strip()
+        result = pd.Series(pd.NaT, index=s.index, dtype="datetime64[ns]")
+
+        has_month = s.str.contains("月", regex=False)
+        has_nendo = s.str.contains("年度", regex=False) & ~has_month
+        has_year = s.str.contains("年", regex=False) & ~has_month & ~has_nendo
+        is_digit = s.str.fullmatch(r"\d+") & ~has_month & ~has_nendo & ~has_year
+        lengths = s.str.len()
+
+        # (マスク, 変換後の文字列, format) の組
+        buckets = [
+            # 2023年1月 -> 2023-1-01
+            (has_month, lambda x: x.str.replace("年", "-", regex=False).str.replace("月", "-01", regex=False), "%Y-%m-%d"),
+            # 2023年度 -> 2023-04-01
+            (has_nendo, lambda x: x.str.replace("年度", "-04-01", regex=False), "%Y-%m-%d"),
+            # 2023年 -> 2023-01-01
+            (has_year, lambda x: x.str.replace("年", "-01-01", regex=False), "%Y-%m-%d"),
+            # YYYYMM (6桁) -> 202301 -> 2023-01-01
+            (is_digit & (lengths == 6), lambda x: x, "%Y%m"),
+            # YYYYMMDD (8桁)
+            (is_digit & (lengths == 8), lambda x: x, "%Y%m%d"),
+            # YYYY (4桁)
+            (is_digit & (lengths == 4), lambda x: x, "%Y"),
+        ]
+
+        parsed = pd.Series(False, index=s.index)
+        for mask, normalize, fmt in buckets:
+            if mask.any():
+                result[mask] = pd.to_datetime(normalize(s[mask]), format=fmt, errors="coerce", cache=True)
+            parsed |= mask
+
+        # どのパターンにも当てはまらないものは汎用パーサーに任せる
+        rest = ~parsed
+        if rest.any():
+            result[rest] = pd.to_datetime(s[rest], format="mixed", errors="coerce", cache=True)
+
+        return result
+
     def _apply_metadata(self, df: pd.DataFrame, class_info: List[Dict[str, Any]]) -> pd.DataFrame:
+        """
+        コード列をラベル付きのカテゴリ型列に変換する。
+        コード数は高々数十件なので、行ごとの dict 参照ではなく
+        get_indexer でコード位置を一括計算し、Categorical として組み立てる。
+        """
+        drop_cols = []
         for obj in class_info:
             col_id, col_name = f"@{obj['@id']}", obj['@name']
             if col_id in df.columns:
                 class_list = obj.get("CLASS", [])
                 if isinstance(class_list, dict):
                     class_list = [class_list]
-                code_to_label = {item["@code"]: item["@name"] for item in class_list if "@code" in item}
-                df[col_name] = df[col_id].map(code_to_label)
-                df = df.drop(columns=[col_id])
-        return df
+                class_list = [item for item in class_list if "@code" in item]
+                codes = pd.Index([item["@code"] for item in class_list])
+                labels = np.array([item["@name"] for item in class_list], dtype=object)
+
+                # 同名ラベルが複数コードに割り当てられている場合に備えてラベル側も一意化する
+                label_codes, categories = pd.factorize(labels)
+                positions = codes.get_indexer(df[col_id].to_numpy())
+                cat_codes = np.full(len(positions), -1, dtype=np.int64)
+                hit = positions >= 0
+                cat_codes[hit] = label_codes[positions[hit]]
+
+                df[col_name] = pd.Categorical.from_codes(cat_codes, categories=categories)
+                drop_cols.append(col_id)
+        return df.drop(columns=drop_cols)
 
     def to_wide_format(self, df: pd.DataFrame, index_col: str = "date", columns_col: str = "品目分類", values_col: str = "value") -> pd.DataFrame:
         """
@@ -139,13 +261,25 @@ class EStatService:
         if columns_col not in df.columns:
             wide_df = df.set_index(index_col)[[values_col]].sort_index()
             wide_df.columns = ["value"]
+        elif not df.duplicated(subset=[index_col, columns_col]).any():
+            # (日付, 品目) が一意なら集計は不要 -> unstack で直接横持ちにする
+            # pivot_table と同様に、キーが欠損の行 (ラベル未定義の品目コード等) と全て欠損の行・列は落とす
+            keyed = df.dropna(subset=[index_col, columns_col])
+            wide_df = keyed.set_index([index_col, columns_col])[values_col].unstack(columns_col)
+            wide_df = wide_df.dropna(how='all').dropna(axis=1, how='all').sort_index()
         else:
-            wide_df = df.pivot_table(index=index_col, columns=columns_col, values=values_col, aggfunc='mean')
+            # 重複がある場合のみ集計する。日付順に並べ、品目列をカテゴリ型(整数コード)にしておくことで
+            # groupby のキーが文字列ハッシュではなく整数コードになる
+            if not df[index_col].is_monotonic_increasing:
+                df = df.sort_values(index_col, kind='stable')
+            if not isinstance(df[columns_col].dtype, pd.CategoricalDtype):
+                df = df.assign(**{columns_col: df[columns_col].astype('category')})
+            wide_df = df.pivot_table(index=index_col, columns=columns_col, values=values_col, aggfunc='mean', observed=True)
             wide_df = wide_df.sort_index()
 
         # 欠損値処理
         wide_df = wide_df.interpolate(method='linear', limit_direction='both')
-        wide_df = wide_df.fillna(method='bfill').fillna(method='ffill')
+        wide_df = wide_df.bfill().ffill()
 
         return wide_df
 
@@ -1,6 +1,7 @@
 import streamlit as st
-import requests
+import httpx
 import pandas as pd
+import numpy as np
 import plotly.graph_objects as go
 
 # --- 1. Page Configuration ---
@@ -24,6 +25,131 @@ STATS_CATALOG = {
     }
 }
 
+# バックエンドへの接続はセッション内で使い回す (クリックのたびに接続を張り直さない)
+if 'http' not in st.session_state:
+    st.session_state['http'] = httpx.Client(base_url=BACKEND_URL, timeout=120.0)
+
+# 同じ (統計表ID, 品目, 地域, 予測期間) の分析結果は1時間キャッシュし、バックエンドへ再リクエストしない
+@st.cache_data(ttl=3600, show_spinner=False)
+def run_analysis(stats_id: str, cat: str, area: str, n_periods: int) -> dict:
+    """バックエンドの予測APIを呼び出し、レスポンスのJSONを返す (HTTPエラーは例外として送出)"""
+    response = st.session_state['http'].get(
+        f"/analysis/predict/{stats_id}",
+        params={"cat": cat, "area": area, "n_periods": n_periods}
+    )
+    response.raise_for_status()
+    return response.json()
+
+def build_ci_polygon(x: np.ndarray, lower: np.ndarray, upper: np.ndarray, last_x, last_y) -> tuple[np.ndarray, np.ndarray]:
+    """
+    信頼区間の閉じたポリゴン (実績の最終点 -> 上限 -> 下限(逆順) -> 実績の最終点) を組み立てる。
+    出力配列を1回だけ確保し、逆順部分もビュー経由で書き込むので中間配列を作らない。
+    """
+    n = len(x)
+    poly_x = np.empty(2 * n + 2, dtype=x.dtype)
+    poly_y = np.empty(2 * n + 2, dtype=np.float64)
+    poly_x[0] = poly_x[-1] = last_x
+    poly_y[0] = poly_y[-1] = last_y
+    poly_x[1:n + 1] = x
+    poly_x[n + 1:2 * n + 1] = x[::-1]
+    poly_y[1:n + 1] = upper
+    poly_y[n + 1:2 * n + 1] = lower[::-1]
+    return poly_x, poly_y
+
+# 描画関数: 入力が同じなら、ウィジェット操作による再実行のたびに図を作り直さない
+@st.cache_data(max_entries=64, show_spinner=False)
+def build_forecast_figure(
+    history_dates: np.ndarray,
+    history_values: np.ndarray,
+    forecast_dates: np.ndarray,
+    forecast_mean: np.ndarray,
+    forecast_lower: np.ndarray,
+    forecast_upper: np.ndarray,
+) -> go.Figure:
+    """実績・予測・95%信頼区間を重ねたファンチャートを生成する"""
+    fig = go.Figure()
+
+    # 描画用データ準備 (予測線・信頼区間は実績の最終点から描き始める)
+    last_x = history_dates[-1:]
+    last_y = history_values[-1:]
+
+    # 信頼区間
+    x_ci, y_ci = build_ci_polygon(forecast_dates, forecast_lower, forecast_upper, last_x[0], last_y[0])
+
+    fig.add_trace(go.Scatter(
+        x=x_ci, y=y_ci,
+        fill='toself', fillcolor='rgba(100, 100, 100, 0.2)',
+        line=dict(color='rgba(255,255,255,0)'),
+        name='95% Confidence Interval (リスク範囲)',
+        hoverinfo="skip"
+    ))
+
+    # 実績
+    fig.add_trace(go.Scatter(
+        x=history_dates, y=history_values,
+        mode='lines', name='実績 (History)',
+        line=dict(color='black', width=1.5)
+    ))
+
+    # 予測
+    x_pred = np.concatenate((last_x, forecast_dates))
+    y_pred = np.concatenate((last_y, forecast_mean))
+
+    fig.add_trace(go.Scatter(
+        x=x_pred, y=y_pred,
+        mode='lines', name='AI予測 (Forecast)',
+        line=dict(color='blue', width=2)
+    ))
+
+    # 期間選択UI (Zoom機能)
+    default_start = pd.Timestamp(history_dates[-1]) - pd.DateOffset(years=5)
+    default_end = pd.Timestamp(forecast_dates[-1]) + pd.DateOffset(months=1)
+
+    fig.update_layout(
+        height=500, hovermode="x unified", template="simple_white",
+        legend=dict(orientation="h", y=1.02, x=0.5, xanchor="center"),
+        yaxis_title="Index Value", 
+        xaxis=dict(
+            title="Year",
+            range=[default_start, default_end], # 初期表示は直近5年+未来
+            rangeselector=dict(
+                buttons=list([
+                    dict(count=1, label="1y", step="year", stepmode="backward"),
+                    dict(count=5, label="5y", step="year", stepmode="backward"),
+                    dict(count=10, label="10y", step="year", stepmode="backward"),
+                    dict(step="all", label="All")
+                ])
+            ),
+            rangeslider=dict(visible=True),
+            type="date"
+        )
+    )
+    return fig
+
+@st.cache_data(max_entries=64, show_spinner=False)
+def build_profit_figure(current_profit: float, future_profit_passive: float, future_profit_active: float) -> go.Figure:
+    """現在・放置・対策後の営業利益を比較する棒グラフを生成する"""
+    fig_sim = go.Figure()
+    x_vals = ["現在", "放置した場合", "値上げ対策後"]
+    y_vals = [current_profit, future_profit_passive, future_profit_active]
+    
+    colors = ['gray', 'crimson' if future_profit_passive < 0 else 'salmon', '#00CC96']
+    
+    fig_sim.add_trace(go.Bar(
+        x=x_vals, y=y_vals,
+        marker_color=colors,
+        text=[f"{v:.1f}百万円" for v in y_vals],
+        textposition='auto',
+    ))
+    
+    fig_sim.update_layout(
+        title="営業利益の推移予測",
+        yaxis_title="営業利益 (百万円)",
+        height=350,
+        template="plotly_white"
+    )
+    return fig_sim
+
 # --- 3. Sidebar ---
 st.sidebar.title("🎮 Control Panel")
 st.sidebar.subheader("1. Select Indicator")
@@ -43,19 +169,15 @@ if 'data' not in st.session_state:
 if st.button("🚀 Run AI Analysis", type="primary"):
     with st.spinner(f'Analyzing {selected_name}...'):
         try:
-            req_params = selected_meta['params'].copy()
-            req_params["n_periods"] = n_periods
-            
-            response = requests.get(
-                f"{BACKEND_URL}/analysis/predict/{selected_meta['id']}", 
-                params=req_params
-            )
-            
-            if response.status_code != 200:
-                st.error(f"Analysis Failed: {response.text}")
+            req_params = selected_meta['params']
+            try:
+                result_json = run_analysis(
+                    selected_meta['id'], req_params['cdCat01'], req_params['cdArea'], n_periods
+                )
+            except httpx.HTTPStatusError as he:
+                st.error(f"Analysis Failed: {he.response.text}")
                 st.stop()
             
-            result_json = response.json()
             if not result_json.get("history") or not result_json.get("forecast"):
                 st.error("Invalid Data")
                 st.stop()
@@ -89,6 +211,10 @@ if st.session_state['data']:
     elif not isinstance(forecast_df.index, pd.DatetimeIndex):
         pass
 
+    # 両タブで使う値は1回だけ取り出す
+    last_hist_value = history_df['value'].iloc[-1]
+    last_pred_value = forecast_df['mean'].iloc[-1]
+
     # タブ生成
     tab1, tab2 = st.tabs(["📊 Macro Forecast (未来予測)", "🎮 Business Simulator (経営判断)"])
 
@@ -100,73 +226,20 @@ if st.session_state['data']:
         """)
         
         # 重要な数値をKPIとして表示
-        last_hist_val = history_df['value'].iloc[-1]
-        last_pred_val = forecast_df['mean'].iloc[-1]
-        change_rate = (last_pred_val - last_hist_val) / last_hist_val * 100
+        change_rate = (last_pred_value - last_hist_value) / last_hist_value * 100
         
         col_kpi1, col_kpi2, col_kpi3 = st.columns(3)
-        col_kpi1.metric("現在の値", f"{last_hist_val:.1f}")
-        col_kpi2.metric("予測値 (期末)", f"{last_pred_val:.1f}", f"{change_rate:+.2f}%")
+        col_kpi1.metric("現在の値", f"{last_hist_value:.1f}")
+        col_kpi2.metric("予測値 (期末)", f"{last_pred_value:.1f}", f"{change_rate:+.2f}%")
         col_kpi3.info("💡 **青い線**が予測シナリオ、**グレーの帯**は不確実性（リスク幅）を示します。")
 
-        fig = go.Figure()
-
-        # 描画用データ準備
-        last_hist_date = history_df['date'].iloc[-1]
-        last_hist_value = history_df['value'].iloc[-1]
-        plot_forecast_df = forecast_df.copy()
-        
-        # 信頼区間
-        x_ci = [last_hist_date] + list(plot_forecast_df.index) + list(plot_forecast_df.index)[::-1] + [last_hist_date]
-        y_ci = [last_hist_value] + list(plot_forecast_df['upper']) + list(plot_forecast_df['lower'])[::-1] + [last_hist_value]
-        
-        fig.add_trace(go.Scatter(
-            x=x_ci, y=y_ci,
-            fill='toself', fillcolor='rgba(100, 100, 100, 0.2)',
-            line=dict(color='rgba(255,255,255,0)'),
-            name='95% Confidence Interval (リスク範囲)',
-            hoverinfo="skip"
-        ))
-
-        # 実績
-        fig.add_trace(go.Scatter(
-            x=history_df['date'], y=history_df['value'],
-            mode='lines', name='実績 (History)',
-            line=dict(color='black', width=1.5)
-        ))
-        
-        # 予測
-        x_pred = [last_hist_date] + list(plot_forecast_df.index)
-        y_pred = [last_hist_value] + list(plot_forecast_df['mean'])
-        
-        fig.add_trace(go.Scatter(
-            x=x_pred, y=y_pred,
-            mode='lines', name='AI予測 (Forecast)',
-            line=dict(color='blue', width=2)
-        ))
-        
-        # 期間選択UI (Zoom機能)
-        default_start = last_hist_date - pd.DateOffset(years=5)
-        default_end = plot_forecast_df.index[-1] + pd.DateOffset(months=1)
-
-        fig.update_layout(
-            height=500, hovermode="x unified", template="simple_white",
-            legend=dict(orientation="h", y=1.02, x=0.5, xanchor="center"),
-            yaxis_title="Index Value", 
-            xaxis=dict(
-                title="Year",
-                range=[default_start, default_end], # 初期表示は直近5年+未来
-                rangeselector=dict(
-                    buttons=list([
-                        dict(count=1, label="1y", step="year", stepmode="backward"),
-                        dict(count=5, label="5y", step="year", stepmode="backward"),
-                        dict(count=10, label="10y", step="year", stepmode="backward"),
-                        dict(step="all", label="All")
-                    ])
-                ),
-                rangeslider=dict(visible=True),
-                type="date"
-            )
+        fig = build_forecast_figure(
+            history_df['date'].to_numpy(),
+            history_df['value'].to_numpy(dtype=float),
+            forecast_df.index.to_numpy(),
+            forecast_df['mean'].to_numpy(dtype=float),
+            forecast_df['lower'].to_numpy(dtype=float),
+            forecast_df['upper'].to_numpy(dtype=float),
         )
         st.plotly_chart(fig, use_container_width=True)
 
@@ -179,9 +252,7 @@ if st.session_state['data']:
         
         if not history_df.empty and not forecast_df.empty:
             # 変動率計算
-            current_val = history_df['value'].iloc[-1]
-            future_val = forecast_df['mean'].iloc[-1]
-            macro_change_pct = (future_val - current_val) / current_val * 100
+            macro_change_pct = (last_pred_value - last_hist_value) / last_hist_value * 100
             
             st.divider() # 区切り線
 
@@ -227,25 +298,7 @@ if st.session_state['data']:
                 future_profit_active = future_revenue_active - future_cost_passive
                 
                 # チャート描画
-                fig_sim = go.Figure()
-                x_vals = ["現在", "放置した場合", "値上げ対策後"]
-                y_vals = [current_profit, future_profit_passive, future_profit_active]
-                
-                colors = ['gray', 'crimson' if future_profit_passive < 0 else 'salmon', '#00CC96']
-                
-                fig_sim.add_trace(go.Bar(
-                    x=x_vals, y=y_vals,
-                    marker_color=colors,
-                    text=[f"{v:.1f}百万円" for v in y_vals],
-                    textposition='auto',
-                ))
-                
-                fig_sim.update_layout(
-                    title="営業利益の推移予測",
-                    yaxis_title="営業利益 (百万円)",
-                    height=350,
-                    template="plotly_white"
-                )
+                fig_sim = build_profit_figure(current_profit, future_profit_passive, future_profit_active)
                 st.plotly_chart(fig_sim, use_container_width=True)
                 
                 # 診断コメント